@@ -1,34 +1,21 @@
 import click
 import logging
-from pathlib import Path
-import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from services.document_service import DocumentService
+from services.document_service import DocumentService, calculate_file_hash, iter_supported_files
 from config.agents import AGENTS_CONFIG
+from utils.log import configure_logging
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-def calculate_file_hash(file_path: Path) -> str:
-    """Calcola l'hash MD5 di un file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+# Oltre questo numero di file modificati l'indice vettoriale viene ricostruito da zero
+INDEX_REBUILD_MODIFIED_FILES = 20
 
-def get_file_info(file_path: Path) -> dict:
-    """Ottiene informazioni sul file."""
-    return {
-        'hash': calculate_file_hash(file_path),
-        'mtime': datetime.fromtimestamp(file_path.stat().st_mtime).isoformat(),
-        'size': file_path.stat().st_size
-    }
+# Thread per il calcolo degli hash: la lettura dal disco domina, quindi più dei core
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
 
 @click.group()
 def cli():
@@ -38,7 +25,8 @@ def cli():
 @cli.command()
 @click.option('--agent', '-a', help='ID dell\'agente da aggiornare (es. procedure, marketing, hr)')
 @click.option('--force', '-f', is_flag=True, help='Forza il refresh completo ignorando lo stato precedente')
-def refresh(agent, force):
+@click.option('--workers', '-w', type=click.IntRange(min=1), help='Processi per la conversione dei documenti (default: core - 1)')
+def refresh(agent, force, workers):
     """Aggiorna incrementalmente i documenti per uno o tutti gli agenti."""
     try:
         if agent:
@@ -52,106 +40,106 @@ def refresh(agent, force):
         for agent_id, config in agents_to_refresh.items():
             # Assicurati che l'id sia presente nella config
             config['id'] = agent_id
-            logger.info(f"Aggiornamento documenti per {config['name']}...")
+            if workers:
+                config['document_workers'] = workers
+            logger.info("Aggiornamento documenti per %s...", config['name'])
             doc_service = DocumentService(config['data_paths'], config)
             
             # Verifica se ci sono file da processare
-            files_to_process = []
-            for data_path in config['data_paths']:
-                path = Path(data_path)
-                logger.info(f"Cercando documenti in: {path}")
-                if path.exists():
-                    logger.info(f"Directory {path} esiste")
-                    for file_path in path.glob("*.*"):
-                        logger.info(f"Trovato file: {file_path}")
-                        if file_path.suffix.lower() in ['.pdf', '.txt', '.docx']:
-                            logger.info(f"File supportato trovato: {file_path}")
-                            files_to_process.append(file_path)
-                        else:
-                            logger.info(f"File non supportato: {file_path}")
-                else:
-                    logger.info(f"Directory {path} non esiste")
+            files_to_process = list(iter_supported_files(config['data_paths']))
             
             if not files_to_process:
-                logger.info(f"Nessun documento trovato per {config['name']}")
+                logger.info("Nessun documento trovato per %s", config['name'])
                 continue
                 
             # Se è force o la tabella non esiste, processa tutto
-            if force or doc_service.table_name not in doc_service.db.table_names():
+            if force or not doc_service.table_exists:
                 if force:
                     logger.info("Modalità force: riprocessamento completo...")
-                    if doc_service.table_name in doc_service.db.table_names():
-                        doc_service.db.drop_table(doc_service.table_name)
+                    if doc_service.table_exists:
+                        doc_service.drop_table()
                 else:
-                    logger.info(f"Creazione nuova tabella: {doc_service.table_name}")
+                    logger.info("Creazione nuova tabella: %s", doc_service.table_name)
+                # L'indice vettoriale viene creato da add_documents
                 doc_service.process_documents()
                 continue
             
             # Modalità incrementale
-            table = doc_service.db.open_table(doc_service.table_name)
+            table = doc_service.get_table()
             existing_files = {}
-            existing_records = {}
             
             if 'metadata' in table.schema.names:
-                df = table.to_pandas()
-                if not df.empty and 'metadata' in df.columns:
-                    logger.info(f"Trovati {len(df)} record nel database")
-                    for _, row in df.iterrows():
-                        metadata = row.metadata
-                        source = metadata['source']
-                        if source not in existing_records:
-                            existing_records[source] = []
-                        existing_records[source].append(row.to_dict())
-                        
-                        # Mantieni i metadata per il confronto
-                        existing_files[source] = {
-                            'hash': metadata.get('file_hash', ''),
-                            'mtime': metadata.get('last_modified', ''),
-                            'size': metadata.get('file_size', 0)
-                        }
-                    logger.info(f"File esistenti nel DB: {list(existing_files.keys())}")
+                num_records = 0
+                for metadata in doc_service.iter_metadata():
+                    num_records += 1
+                    # Mantieni i metadata per il confronto
+                    existing_files[metadata['source']] = {
+                        'hash': metadata.get('file_hash', ''),
+                        'mtime': metadata.get('last_modified', ''),
+                        'size': metadata.get('file_size', 0)
+                    }
+                if num_records:
+                    logger.info("Trovati %d record nel database", num_records)
+                    # Elenco completo solo in debug: con molti file è costoso da costruire
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("File esistenti nel DB: %s", list(existing_files))
             
             new_files = []
             modified_files = []
+            files_to_process.sort()
             
+            # Basta lo stat: un file con metadata completi e mtime o dimensione diversi è
+            # modificato senza leggerlo (add_documents ne calcolerà l'hash); l'hash serve
+            # solo per riparare i metadata incompleti senza rifare gli embedding
+            to_repair = {}
             for file_path in files_to_process:
                 file_str = str(file_path)
                 if file_str not in existing_files:
-                    logger.info(f"Nuovo file trovato: {file_path}")
+                    logger.info("Nuovo file trovato: %s", file_path)
                     new_files.append(file_path)
-                else:
-                    # Se il file esiste, controlla se è stato modificato
-                    current_hash = calculate_file_hash(file_path)
-                    current_mtime = datetime.fromtimestamp(file_path.stat().st_mtime).isoformat()
-                    current_size = file_path.stat().st_size
-                    
-                    stored_info = existing_files[file_str]
-                    if not all(stored_info.values()):
-                        # Se mancano i metadata, aggiorna solo i metadata mantenendo gli embedding esistenti
-                        logger.info(f"Aggiornamento metadata per file esistente: {file_path}")
-                        records_to_update = existing_records[file_str]
-                        for record in records_to_update:
-                            record['metadata'].update({
-                                'file_hash': current_hash,
-                                'last_modified': current_mtime,
-                                'file_size': current_size
-                            })
-                    elif (current_hash != stored_info['hash'] or 
-                          current_mtime != stored_info['mtime'] or 
-                          current_size != stored_info['size']):
-                        logger.info(f"File modificato rilevato: {file_path}")
-                        modified_files.append(file_path)
+                    continue
+                stored_info = existing_files[file_str]
+                file_stat = file_path.stat()
+                current_mtime = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
+                current_size = file_stat.st_size
+                if not all(stored_info.values()):
+                    to_repair[file_path] = (current_mtime, current_size)
+                elif current_mtime != stored_info['mtime'] or current_size != stored_info['size']:
+                    logger.info("File modificato rilevato: %s", file_path)
+                    modified_files.append(file_path)
+            
+            # Hash in parallelo: la lettura e l'MD5 rilasciano il GIL
+            with ThreadPoolExecutor(max_workers=min(HASH_WORKERS, len(to_repair) or 1)) as executor:
+                current_hashes = dict(zip(to_repair, executor.map(calculate_file_hash, to_repair)))
+            
+            for file_path, (current_mtime, current_size) in to_repair.items():
+                # Se mancano i metadata, aggiorna solo i metadata mantenendo gli embedding esistenti
+                logger.info("Aggiornamento metadata per file esistente: %s", file_path)
+                file_str = str(file_path)
+                # Carica solo i record di questo file, non l'intera tabella
+                records_to_update = doc_service.get_records(file_str)
+                for record in records_to_update:
+                    record['metadata'].update({
+                        'file_hash': current_hashes[file_path],
+                        'last_modified': current_mtime,
+                        'file_size': current_size
+                    })
+                doc_service.replace_records(file_str, records_to_update)
             
             if new_files or modified_files:
                 if new_files:
-                    logger.info(f"Trovati {len(new_files)} nuovi documenti da processare")
+                    logger.info("Trovati %d nuovi documenti da processare", len(new_files))
                 if modified_files:
-                    logger.info(f"Trovati {len(modified_files)} documenti modificati da aggiornare")
+                    logger.info("Trovati %d documenti modificati da aggiornare", len(modified_files))
                 
                 # Processa solo i file nuovi e modificati
-                doc_service.add_documents(new_files + modified_files, existing_records)
+                doc_service.add_documents(
+                    new_files + modified_files,
+                    replaced_files=modified_files,
+                    rebuild_index=len(modified_files) > INDEX_REBUILD_MODIFIED_FILES
+                )
             else:
-                logger.info(f"Nessun nuovo documento o modifica da processare per {config['name']}")
+                logger.info("Nessun nuovo documento o modifica da processare per %s", config['name'])
             
         logger.info("Operazione completata con successo!")
         
@@ -1,52 +1,67 @@
+import gc
 import streamlit as st
-from config.agents import AGENTS_CONFIG
+from config.agents import AGENTS_CONFIG, AGENT_TITLES
+from utils.state import CHAT_HISTORY_MAXLEN
+from utils.services import get_agent_services
+from utils.refresh import is_refreshing
+from collections import deque
 import logging
 
 logger = logging.getLogger(__name__)
 
-def render_chat(selected_agent_id, services):
-    """Render the chat interface."""
-    current_services = services[selected_agent_id]
-    
+@st.cache_data(ttl=600, max_entries=512, show_spinner=False)
+def cached_search(agent_id, prompt):
+    """Search the agent's documents, caching results per (agent_id, prompt)."""
+    return get_agent_services(agent_id)['doc_service'].search_documents(prompt)
+
+@st.fragment
+def render_chat(selected_agent_id, current_services):
+    """Render the chat interface for the selected agent's services."""
+
+    agent_name = AGENTS_CONFIG[selected_agent_id]['name']
+
     # Main chat interface
-    st.title(f"{AGENTS_CONFIG[selected_agent_id]['icon']} {AGENTS_CONFIG[selected_agent_id]['name']}")
+    st.title(AGENT_TITLES[selected_agent_id])
 
     # Initialize messages for new agents
-    if selected_agent_id not in st.session_state.agent_messages:
-        st.session_state.agent_messages[selected_agent_id] = []
+    messages = st.session_state.agent_messages.setdefault(
+        selected_agent_id, deque(maxlen=CHAT_HISTORY_MAXLEN)
+    )
 
     # Display chat history
-    for message in st.session_state.agent_messages[selected_agent_id]:
+    for message in messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
-    # Chat input
-    if prompt := st.chat_input(f"Chiedi all'esperto {AGENTS_CONFIG[selected_agent_id]['name']}..."):
+    # Chat input, disabilitato finché l'indicizzazione in background non termina
+    refreshing = is_refreshing()
+    if refreshing:
+        st.info("Indicizzazione in corso…")
+    if prompt := st.chat_input(f"Chiedi all'esperto {agent_name}...", disabled=refreshing):
         # Display user message
         with st.chat_message("user"):
             st.markdown(prompt)
 
         # Add user message to history
-        st.session_state.agent_messages[selected_agent_id].append(
-            {"role": "user", "content": prompt}
-        )
+        messages.append({"role": "user", "content": prompt})
 
         # Get assistant response
         try:
-            results = current_services['doc_service'].search_documents(prompt)
-            context = "\n\n".join([r['text'] for r in results])
+            results = cached_search(selected_agent_id, prompt)
+            context = "\n\n".join(r['text'] for r in results)
             
             with st.chat_message("assistant"):
-                response = current_services['assistant_service'].get_assistant_response(
-                    st.session_state.agent_messages[selected_agent_id], 
-                    context
+                response = st.write_stream(
+                    current_services['assistant_service'].get_assistant_response(
+                        messages, 
+                        context
+                    )
                 )
-                st.markdown(response)
 
             # Add assistant response to history
-            st.session_state.agent_messages[selected_agent_id].append(
-                {"role": "assistant", "content": response}
-            )
+            messages.append({"role": "assistant", "content": response})
+            # Raccoglie ora i temporanei del turno, fuori dal percorso di rendering
+            gc.collect(0)
         
         except Exception as e:
             logger.error(f"Error processing query: {e}", exc_info=True)
@@ -1,4 +1,5 @@
 import streamlit as st
+from services.stats import collect_all_stats, collect_search_cache_stats
 from .overview import render_overview
 from .agents import render_agents_details
 from .stats import render_advanced_stats
@@ -7,15 +8,18 @@ def render_dashboard(services):
     """Render the main dashboard interface."""
     st.title("📊 Status Dashboard")
     
+    # Statistiche raccolte una volta sola e condivise dai tre tab
+    all_stats = collect_all_stats(services)
+    
     # Create tabs
     tab1, tab2, tab3 = st.tabs(["📑 Overview", "🤖 Agenti", "📈 Statistiche"])
     
     # Render each tab
     with tab1:
-        render_overview(services)
+        render_overview(all_stats)
     
     with tab2:
-        render_agents_details(services)
+        render_agents_details(all_stats)
     
     with tab3:
-        render_advanced_stats(services)
\ No newline at end of file
+        render_advanced_stats(all_stats, collect_search_cache_stats(services))
\ No newline at end of file
@@ -1,27 +1,29 @@
 import streamlit as st
 import plotly.express as px
 import pandas as pd
-from config.agents import AGENTS_CONFIG
-from services.stats import get_document_stats
+from config.agents import AGENT_IDS, AGENT_TITLES
 
-def render_overview(services):
+@st.cache_data(show_spinner=False)
+def build_overview_fig(docs_per_agent):
+    """Build the documents/chunks bar chart (cached on the dataframe content)."""
+    return px.bar(docs_per_agent, 
+                  x='Agente', 
+                  y=['Documenti', 'Chunks'],
+                  barmode='group',
+                  title="Documenti e Chunks per Agente")
+
+@st.fragment
+def render_overview(all_stats):
     """Render the overview tab of the dashboard."""
     st.header("📑 Overview Sistema")
     
     # Metriche principali
     col1, col2, col3, col4 = st.columns(4)
     
-    total_agents = len(AGENTS_CONFIG)
-    total_docs = 0
-    total_chunks = 0
+    total_agents = len(AGENT_IDS)
     
-    # Raccogli statistiche per tutti gli agenti
-    all_stats = []
-    for agent_id, config in AGENTS_CONFIG.items():
-        stats = get_document_stats(agent_id, config, services[agent_id]['doc_service'])
-        all_stats.append(stats)
-        total_docs += stats['total_documents']
-        total_chunks += stats['total_chunks']
+    total_docs = sum(stats['total_documents'] for stats in all_stats)
+    total_chunks = sum(stats['total_chunks'] for stats in all_stats)
     
     with col1:
         st.metric("Agenti Attivi", total_agents)
@@ -35,19 +37,14 @@ def render_overview(services):
     
     # Grafico distribuzione documenti per agente
     st.subheader("Distribuzione Documenti per Agente")
-    docs_per_agent = pd.DataFrame([
-        {'Agente': f"{stats['icon']} {stats['name']}", 
-         'Documenti': stats['total_documents'],
-         'Chunks': stats['total_chunks']}
-        for stats in all_stats
-    ])
+    docs_per_agent = pd.DataFrame({
+        'Agente': [AGENT_TITLES[stats['agent_id']] for stats in all_stats],
+        'Documenti': [stats['total_documents'] for stats in all_stats],
+        'Chunks': [stats['total_chunks'] for stats in all_stats]
+    })
     
     if not docs_per_agent.empty:
-        fig = px.bar(docs_per_agent, 
-                     x='Agente', 
-                     y=['Documenti', 'Chunks'],
-                     barmode='group',
-                     title="Documenti e Chunks per Agente")
+        fig = build_overview_fig(docs_per_agent)
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("Nessun documento presente nel sistema") 
\ No newline at end of file
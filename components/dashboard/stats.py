@@ -1,55 +1,82 @@
 import streamlit as st
 import plotly.express as px
 import pandas as pd
-from config.agents import AGENTS_CONFIG
-from services.stats import get_document_stats
+from config.agents import AGENT_TITLES
 
-def render_advanced_stats(services):
+@st.cache_data(ttl=300, show_spinner=False)
+def build_timeline_df(timeline_rows):
+    """Build the update timeline dataframe, cached on the (agent_id, filename, last_modified) rows."""
+    timeline_df = pd.DataFrame(
+        [(AGENT_TITLES[agent_id], filename, last_modified) for agent_id, filename, last_modified in timeline_rows],
+        columns=['Agente', 'File', 'Data']
+    )
+    # Un solo parsing vettoriale invece di pd.to_datetime per ogni documento
+    timeline_df['Data'] = pd.to_datetime(timeline_df['Data'], format='ISO8601', errors='coerce')
+    return timeline_df.dropna(subset=['Data']).sort_values('Data')
+
+@st.cache_data(show_spinner=False)
+def build_chunks_pie(chunks_data):
+    """Build the chunks distribution pie chart (cached on the dataframe content)."""
+    return px.pie(chunks_data, 
+                  values='Chunks', 
+                  names='Agente',
+                  title="Distribuzione Chunks tra Agenti")
+
+@st.cache_data(show_spinner=False)
+def build_timeline_fig(timeline_df):
+    """Build the updates timeline chart (cached on the dataframe content)."""
+    fig = px.timeline(timeline_df, 
+                      x_start='Data',
+                      y='Agente',
+                      color='Agente',
+                      hover_data=['File'])
+    fig.update_layout(showlegend=False)
+    return fig
+
+@st.fragment
+def render_advanced_stats(all_stats, cache_stats):
     """Render the advanced statistics tab of the dashboard."""
     st.header("📈 Statistiche Avanzate")
     
-    # Raccogli statistiche per tutti gli agenti
-    all_stats = []
-    for agent_id, config in AGENTS_CONFIG.items():
-        stats = get_document_stats(agent_id, config, services[agent_id]['doc_service'])
-        all_stats.append(stats)
-    
     # Grafico a torta della distribuzione dei chunks
     chunks_data = pd.DataFrame([
-        {'Agente': f"{stats['icon']} {stats['name']}", 
+        {'Agente': AGENT_TITLES[stats['agent_id']], 
          'Chunks': stats['total_chunks']}
         for stats in all_stats if stats['total_chunks'] > 0
     ])
     
     if not chunks_data.empty:
-        fig = px.pie(chunks_data, 
-                     values='Chunks', 
-                     names='Agente',
-                     title="Distribuzione Chunks tra Agenti")
+        fig = build_chunks_pie(chunks_data)
         st.plotly_chart(fig, use_container_width=True)
     
+    # Efficacia della cache delle ricerche (contatori dall'avvio del processo)
+    st.subheader("Cache Ricerche")
+    cache_df = pd.DataFrame([
+        {'Agente': AGENT_TITLES[stats['agent_id']],
+         'Voci': stats['size'],
+         'Hit esatti': stats['hits'],
+         'Hit simili': stats['similar_hits'],
+         'Miss': stats['misses'],
+         'Hit rate': f"{stats['hit_rate']:.0%}"}
+        for stats in cache_stats
+    ])
+    st.dataframe(cache_df, hide_index=True, use_container_width=True)
+    
     # Timeline aggiornamenti
     st.subheader("Timeline Aggiornamenti")
-    timeline_data = []
-    for stats in all_stats:
-        for doc in stats['documents']:
-            if doc['last_modified'] != 'N/A':
-                timeline_data.append({
-                    'Agente': f"{stats['icon']} {stats['name']}",
-                    'File': doc['filename'],
-                    'Data': pd.to_datetime(doc['last_modified'])
-                })
+    if not any(stats['has_timestamps'] for stats in all_stats):
+        st.info("Nessun dato temporale disponibile")
+        return
+    
+    timeline_df = build_timeline_df(tuple(
+        (stats['agent_id'], doc['filename'], doc['last_modified'])
+        for stats in all_stats
+        for doc in stats['documents']
+        if doc['last_modified'] != 'N/A'
+    ))
     
-    if timeline_data:
-        timeline_df = pd.DataFrame(timeline_data)
-        timeline_df = timeline_df.sort_values('Data')
-        
-        fig = px.timeline(timeline_df, 
-                         x_start='Data',
-                         y='Agente',
-                         color='Agente',
-                         hover_data=['File'])
-        fig.update_layout(showlegend=False)
+    if not timeline_df.empty:
+        fig = build_timeline_fig(timeline_df)
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("Nessun dato temporale disponibile") 
\ No newline at end of file
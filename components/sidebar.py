@@ -1,6 +1,15 @@
 import streamlit as st
-from config.agents import AGENTS_CONFIG
-from services.document_service import DocumentService
+from config.agents import AGENT_IDS, AGENT_TITLES
+from utils.refresh import start_refresh, is_refreshing, refresh_error
+
+# La configurazione è statica: le opzioni del selettore si calcolano una sola volta
+AGENT_OPTIONS = tuple((AGENT_TITLES[agent_id], agent_id) for agent_id in AGENT_IDS)
+AGENT_LABELS = [label for label, _ in AGENT_OPTIONS]
+AGENT_LABEL_TO_ID = dict(AGENT_OPTIONS)
+
+# Footer ancorato in fondo alla sidebar via CSS, senza spaziatori HTML
+SIDEBAR_FOOTER_CSS = ("<style>.st-key-sidebar-footer"
+                      "{position: sticky; bottom: 0; margin-top: auto;}</style>")
 
 def render_sidebar():
     """Render the sidebar and return the selected agent ID."""
@@ -9,14 +18,12 @@ def render_sidebar():
         
         # 1. Agent selection
         st.subheader("Scegli l'esperto")
-        agent_options = {f"{config['icon']} {config['name']}": agent_id 
-                        for agent_id, config in AGENTS_CONFIG.items()}
         selected_agent_name = st.selectbox(
             "Seleziona un esperto",
-            options=list(agent_options.keys()),
+            options=AGENT_LABELS,
             key="agent_selector"
         )
-        selected_agent_id = agent_options[selected_agent_name]
+        selected_agent_id = AGENT_LABEL_TO_ID[selected_agent_name]
         
         # 2. Navigation
         st.markdown("---")
@@ -33,6 +40,12 @@ def render_sidebar():
         
         return selected_agent_id
 
+def render_sidebar_footer():
+    """Render the footer pinned to the bottom of the sidebar."""
+    st.markdown(SIDEBAR_FOOTER_CSS, unsafe_allow_html=True)
+    with st.container(key="sidebar-footer"):
+        st.caption("Powered by OpenAI GPT-4 & LanceDB")
+
 def render_admin_actions():
     """Render the admin actions section."""
     st.markdown("---")
@@ -47,26 +60,31 @@ def handle_refresh_button():
         st.toast("Database ricaricato con successo!", icon="✅")
         st.session_state.show_toast = False
     
-    if st.session_state.refresh_state == 'refreshing':
-        st.toast("Ricaricamento in corso...", icon="🔄")
-        try:
-            # Reinizializza i servizi in modalità non read-only per il refresh
-            for agent_id, config in AGENTS_CONFIG.items():
-                doc_service = DocumentService(
-                    data_paths=config['data_paths'],
-                    config=config,
-                    read_only=False
-                )
-                doc_service.process_documents()
-            
-            st.session_state.refresh_state = 'ready'
-            st.session_state.show_toast = True
-            st.cache_resource.clear()
-            st.rerun()
-        except Exception as e:
-            st.error(f"Errore durante il refresh: {str(e)}")
-            st.session_state.refresh_state = 'ready'
+    if st.session_state.refresh_error:
+        st.error(f"Errore durante il refresh: {st.session_state.refresh_error}")
     
-    if st.button("🔄 Ricarica Documenti"):
+    if st.session_state.refresh_state == 'refreshing':
+        render_refresh_status()
+    elif st.button("🔄 Ricarica Documenti"):
+        # L'indicizzazione gira in un thread: la pagina resta utilizzabile
+        start_refresh()
         st.session_state.refresh_state = 'refreshing'
-        st.rerun() 
\ No newline at end of file
+        st.session_state.refresh_error = None
+        st.rerun()
+
+@st.fragment(run_every=2)
+def render_refresh_status():
+    """Poll the background refresh and reload the app when it completes."""
+    if is_refreshing():
+        st.info("Indicizzazione in corso…")
+        return
+    
+    st.session_state.refresh_state = 'ready'
+    error = refresh_error()
+    if error is not None:
+        st.session_state.refresh_error = str(error)
+    else:
+        st.session_state.show_toast = True
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    st.rerun()
@@ -12,6 +12,9 @@ AGENTS_CONFIG = {
             "data/procedure/linee_guida",
             "data/procedure/standard"
         ],
+        "embedding_batch_size": 64,
+        "embedding_concurrency": 8,
+        "history_window": 16,
         "system_prompt": """Sei un esperto di procedure aziendali. 
         Aiuti gli utenti a comprendere e seguire le procedure corrette.
         Rispondi in modo preciso e formale, citando sempre le fonti."""
@@ -26,6 +29,9 @@ AGENTS_CONFIG = {
             "data/marketing/campagne",
             "data/marketing/analisi"
         ],
+        "embedding_batch_size": 64,
+        "embedding_concurrency": 8,
+        "history_window": 16,
         "system_prompt": """Sei un esperto di marketing e comunicazione.
         Aiuti gli utenti con strategie e best practice di marketing.
         Usa un tono professionale ma coinvolgente."""
@@ -39,6 +45,14 @@ AGENTS_CONFIG = {
             "data/hr/policies",
             "data/hr/documenti"
         ],
+        "embedding_batch_size": 64,
+        "embedding_concurrency": 8,
+        "history_window": 16,
         "system_prompt": """Sei un esperto di risorse umane..."""
     }
-}
\ No newline at end of file
+}
+
+# Viste derivate e immutabili, calcolate una sola volta all'import
+AGENT_IDS = tuple(AGENTS_CONFIG)
+AGENT_ITEMS = tuple(AGENTS_CONFIG.items())
+AGENT_TITLES = {agent_id: f"{config['icon']} {config['name']}" for agent_id, config in AGENT_ITEMS}
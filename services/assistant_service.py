@@ -1,18 +1,32 @@
 import logging
 import json
-from typing import List, Dict, Any
-from openai import OpenAI
+import orjson
+from itertools import islice
+from typing import List, Dict, Any, Iterator
+from services.openai_client import get_openai_client
 import numpy as np
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Messaggi più recenti della cronologia inviati al modello a ogni turno (override: config['history_window'])
+MAX_PROMPT_MESSAGES = 16
+
+def _json_default(obj: Any) -> Any:
+    """Fallback per i valori che orjson non serializza nativamente."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 class AssistantService:
     def __init__(self, document_service, agent_config: Dict[str, Any]):
         """Initialize assistant service with specific agent configuration."""
-        self.client = OpenAI()
+        self.client = get_openai_client()
         self.document_service = document_service
         self.agent_config = agent_config
+        self.history_window = agent_config.get('history_window', MAX_PROMPT_MESSAGES)
         self.tools = self._register_tools()
         
         logger.info(f"AssistantService initialized for {agent_config['name']} with {len(self.tools)} tools")
@@ -62,18 +76,6 @@ class AssistantService:
             }
         ]
 
-    def _convert_to_json_serializable(self, obj: Any) -> Any:
-        """Convert objects to JSON serializable format."""
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        if isinstance(obj, (np.int64, np.int32, np.float64, np.float32)):
-            return obj.item()
-        if isinstance(obj, dict):
-            return {k: self._convert_to_json_serializable(v) for k, v in obj.items()}
-        if isinstance(obj, list):
-            return [self._convert_to_json_serializable(i) for i in obj]
-        return obj
-
     def _get_current_datetime(self, format: str = "DD-MM-YYYY HH:mm") -> str:
         """Get the current date and time in the specified format."""
         now = datetime.now()
@@ -87,85 +89,153 @@ class AssistantService:
 
     def execute_function(self, name: str, args: Dict[str, Any]) -> Any:
         """Execute a function by name with given arguments."""
-        logger.info(f"🔧 Function called: {name}")
-        logger.info(f"📝 Arguments: {json.dumps(args, indent=2)}")
+        logger.info("🔧 Function called: %s", name)
+        # Argomenti solo in debug: niente serializzazione JSON se il livello è disattivato
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📝 Arguments: %s", json.dumps(args, indent=2))
         
         if name == "search_documents":
             results = self.document_service.search_documents(
                 args["query"], 
                 args.get("num_results", 3)
             )
-            logger.info(f"📊 Found {len(results)} results")
-            json_safe_results = self._convert_to_json_serializable(results)
-            return {"results": json_safe_results}
+            logger.info("📊 Found %d results", len(results))
+            return {"results": results}
             
         elif name == "get_current_datetime":
             format = args.get("format", "DD-MM-YYYY HH:mm")
             current_time = self._get_current_datetime(format)
-            logger.info(f"⏰ Current time requested: {current_time}")
+            logger.info("⏰ Current time requested: %s", current_time)
             return {"datetime": current_time}
         
         else:
             logger.warning(f"❌ Unknown function: {name}")
             return None
 
-    def get_assistant_response(self, messages: List[Dict[str, str]], context: str = "") -> str:
-        """Get response from assistant with function calling capabilities."""
+    def _execute_tool_calls(self, tool_calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Execute the tool calls of a turn, running all document searches together."""
+        function_args = {tc["id"]: json.loads(tc["function"]["arguments"]) for tc in tool_calls}
+        search_calls = [tc for tc in tool_calls if tc["function"]["name"] == "search_documents"]
+        responses = {}
+        
+        if search_calls:
+            queries = [function_args[tc["id"]]["query"] for tc in search_calls]
+            logger.info("🔧 Function called: search_documents x%d", len(search_calls))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📝 Queries: %s", json.dumps(queries, indent=2))
+            all_results = self.document_service.search_documents_batch(
+                queries,
+                [function_args[tc["id"]].get("num_results", 3) for tc in search_calls]
+            )
+            for tc, results in zip(search_calls, all_results):
+                logger.info("📊 Found %d results", len(results))
+                responses[tc["id"]] = {"results": results}
+        
+        for tc in tool_calls:
+            if tc["id"] not in responses:
+                responses[tc["id"]] = self.execute_function(tc["function"]["name"], function_args[tc["id"]])
+        return responses
+
+    def _stream_first_round(self, stream, tool_calls: List[Dict[str, Any]]) -> Iterator[str]:
+        """Yield the content deltas of a streamed completion, collecting tool calls into `tool_calls`.
+
+        Tool calls arrive fragmented across chunks: id and name come with the first
+        delta of each call, the JSON arguments are split over the following ones.
+        """
+        calls_by_index = {}
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield delta.content
+            for tc_delta in delta.tool_calls or ():
+                call = calls_by_index.setdefault(tc_delta.index, {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc_delta.id:
+                    call["id"] = tc_delta.id
+                if tc_delta.function:
+                    if tc_delta.function.name:
+                        call["function"]["name"] += tc_delta.function.name
+                    if tc_delta.function.arguments:
+                        call["function"]["arguments"] += tc_delta.function.arguments
+        tool_calls.extend(calls_by_index[index] for index in sorted(calls_by_index))
+
+    def _system_prompt(self, has_documents: bool) -> str:
+        """Build the static part of the system prompt (no per-request content)."""
+        if has_documents:
+            guidance = 'Use the available tools to search for information when needed.'
+        else:
+            guidance = 'No documents are currently available. Provide general guidance based on your knowledge.'
+        return (
+            f"{self.agent_config['system_prompt']}\n\n"
+            f"{guidance}\n"
+            "If you're unsure or can't find relevant information, say so."
+        )
+
+    def get_assistant_response(self, messages: List[Dict[str, str]], context: str = "") -> Iterator[str]:
+        """Stream the response from assistant with function calling capabilities."""
         try:
             # Verifica se ci sono documenti
-            table = self.document_service.db.open_table(self.document_service.table_name)
-            df = table.to_pandas()
-            has_documents = not df.empty
-            
-            system_prompt = f"""{self.agent_config['system_prompt']}
-            
-            {'Use the available tools to search for information when needed.' if has_documents else 'No documents are currently available. Provide general guidance based on your knowledge.'}
-            If you're unsure or can't find relevant information, say so.
-            
-            Context:
-            {context}
-            """
+            # count_rows legge solo i metadati della tabella, senza caricare i vettori
+            has_documents = self.document_service.get_table().count_rows() > 0
             
+            # Prefisso statico per agente: identico a ogni chiamata, così la cache
+            # dei prompt di OpenAI può riusarlo; il contesto va in un messaggio a parte
             messages_with_context = [
-                {"role": "system", "content": system_prompt},
-                *messages
+                {"role": "system", "content": self._system_prompt(has_documents)},
+                *([{"role": "system", "content": f"Context:\n{context}"}] if context else []),
+                # Solo la coda della cronologia va nel prompt: costo e latenza restano limitati
+                *islice(messages, max(0, len(messages) - self.history_window), None)
             ]
             
-            response = self.client.chat.completions.create(
+            # Anche il primo giro è in streaming: senza tool call il testo arriva subito
+            stream = self.client.chat.completions.create(
                 model="gpt-4",
                 messages=messages_with_context,
                 tools=self.tools,
-                tool_choice="auto"
+                tool_choice="auto",
+                stream=True
             )
             
-            response_message = response.choices[0].message
+            tool_calls = []
+            yield from self._stream_first_round(stream, tool_calls)
             
-            if response_message.tool_calls:
-                messages_with_context.append(response_message)
+            if tool_calls:
+                messages_with_context.append({
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": tool_calls
+                })
                 
-                for tool_call in response_message.tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    function_response = self.execute_function(function_name, function_args)
-                    # Convertiamo la risposta in formato JSON-serializable
-                    json_safe_response = self._convert_to_json_serializable(function_response)
+                function_responses = self._execute_tool_calls(tool_calls)
+                for tool_call in tool_calls:
+                    function_response = function_responses[tool_call["id"]]
                     
                     messages_with_context.append({
                         "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps(json_safe_response)
+                        "tool_call_id": tool_call["id"],
+                        # Serializzazione in C, con supporto nativo per array e scalari NumPy
+                        "content": orjson.dumps(
+                            function_response,
+                            default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY
+                        ).decode()
                     })
                 
-                final_response = self.client.chat.completions.create(
+                final_stream = self.client.chat.completions.create(
                     model="gpt-4",
-                    messages=messages_with_context
+                    messages=messages_with_context,
+                    stream=True
                 )
                 
-                return final_response.choices[0].message.content
-            
-            return response_message.content
+                for chunk in final_stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
             
         except Exception as e:
             logger.error(f"Error getting assistant response: {str(e)}", exc_info=True)
-            return "Mi dispiace, si è verificato un errore nel generare la risposta." 
\ No newline at end of file
+            yield "Mi dispiace, si è verificato un errore nel generare la risposta." 
\ No newline at end of file
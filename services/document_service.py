@@ -1,22 +1,168 @@
+import asyncio
 import logging
 from pathlib import Path
-from typing import List, Dict, Any, Union
-import lancedb
-from openai import OpenAI
+from functools import cached_property, lru_cache
+from typing import List, Dict, Any, Iterable, Optional, Tuple, Union
+from openai import AsyncOpenAI, RateLimitError
 from docling.document_converter import DocumentConverter
 from docling.chunking import HybridChunker
 from services.tokenizer import OpenAITokenizerWrapper
+from services.embeddings import EmbeddingBatcher
+from services.embedding_cache import EmbeddingCache
+from services.openai_client import get_openai_client
+from services.similarity import normalize
+from services.query_cache import QueryCache
+import numpy as np
+import pyarrow as pa
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
-import json
-import tempfile
+import orjson
+import math
+import mmap
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 from utils.db import connect_to_lancedb
 
 # Configurazione avanzata del logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SUPPORTED_EXTENSIONS = frozenset({'.pdf', '.txt', '.docx'})
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+# Sotto questa soglia la ricerca esatta è già veloce: niente indice ANN
+VECTOR_INDEX_MIN_ROWS = 10_000
+# L'indice viene ricostruito quando la tabella cresce di questo fattore dall'ultima build
+VECTOR_INDEX_REBUILD_GROWTH = 2
+# Sotto-vettori PQ: 1536 / 96 = 16 dimensioni ciascuno, il default di LanceDB
+VECTOR_INDEX_SUB_VECTORS = 96
+# Partizioni IVF visitate per query e fattore di riordino esatto dei candidati
+SEARCH_NPROBES = 20
+SEARCH_REFINE_FACTOR = 10
+# Numero di testi per singola richiesta embeddings (override: config['embedding_batch_size'])
+EMBEDDING_BATCH_SIZE = 64
+# Limiti dell'endpoint embeddings per singola richiesta
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 250_000
+# Richieste embeddings in volo contemporaneamente durante l'ingestione (override: config['embedding_concurrency'])
+EMBEDDING_MAX_CONCURRENCY = 8
+# Tentativi per batch con attesa esponenziale (2s, 4s, ... fino a 60s)
+EMBEDDING_MAX_ATTEMPTS = 3
+EMBEDDING_RETRY_BASE_DELAY = 2
+EMBEDDING_RETRY_MAX_DELAY = 60
+# Risultati di ricerca riutilizzati per query ripetute
+SEARCH_CACHE_TTL = 600
+SEARCH_CACHE_SIZE = 2000
+# Query con embedding così simile a una già in cache ne riusano i risultati
+SEARCH_CACHE_SIMILARITY = 0.98
+# Ricerche eseguite in parallelo da search_documents_batch
+SEARCH_BATCH_WORKERS = 4
+
+# Processi per conversione e chunking dei documenti (lavoro CPU-bound di docling);
+# un core resta al processo principale, che intanto calcola gli embedding (override: config['document_workers'])
+DOCUMENT_WORKERS = int(os.environ.get("DOCLING_WORKERS", max(1, (os.cpu_count() or 1) - 1)))
+
+# Schema delle tabelle degli agenti: vettori float16 a dimensione fissa, metà dei byte
+# da leggere a ogni ricerca (le tabelle float32 esistenti convertono i nuovi dati al volo)
+VECTOR_VALUE_TYPE = pa.float16()
+METADATA_TYPE = pa.struct([
+    ("source", pa.string()),
+    ("filename", pa.string()),
+    ("page_numbers", pa.list_(pa.int64())),
+    ("last_modified", pa.string()),
+    ("file_hash", pa.string()),
+    ("file_size", pa.int64())
+])
+TABLE_SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("vector", pa.list_(VECTOR_VALUE_TYPE, EMBEDDING_DIMENSIONS)),
+    ("metadata", METADATA_TYPE)
+])
+
+def iter_supported_files(data_paths: List[str]):
+    """Restituisce i documenti supportati presenti nelle directory indicate e nelle sottodirectory."""
+    for data_path in data_paths:
+        if not os.path.isdir(data_path):
+            logger.debug("Directory %s non esiste", data_path)
+            continue
+        # os.walk usa scandir: tipo delle voci senza stat extra
+        for root, _, filenames in os.walk(data_path):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                if os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
+                    yield Path(file_path)
+                else:
+                    logger.debug("File non supportato: %s", file_path)
+
+# Token massimi per chunk: il limite di input del modello di embedding
+CHUNK_MAX_TOKENS = 8191
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> OpenAITokenizerWrapper:
+    """Tokenizer condiviso da tutti gli agenti."""
+    return OpenAITokenizerWrapper()
+
+@lru_cache(maxsize=None)
+def get_chunker() -> HybridChunker:
+    """Chunker condiviso da tutti gli agenti, configurato sul tokenizer OpenAI."""
+    return HybridChunker(
+        tokenizer=get_tokenizer(),
+        max_tokens=CHUNK_MAX_TOKENS,
+        merge_peers=True
+    )
+
+@lru_cache(maxsize=None)
+def get_converter() -> DocumentConverter:
+    """Converter docling condiviso da tutti gli agenti."""
+    return DocumentConverter()
+
+def _page_numbers(chunk) -> Optional[List[int]]:
+    """Pagine di provenienza di un chunk docling."""
+    if not hasattr(chunk.meta, 'doc_items'):
+        return None
+    return sorted(set(prov.page_no for item in chunk.meta.doc_items for prov in item.prov))
+
+def _init_worker():
+    """Prepara converter e chunker all'avvio del worker, prima del primo documento."""
+    get_converter()
+    get_chunker()
+
+def _chunk_text_file(file_path: str) -> List[tuple]:
+    """Suddivide un file di testo in finestre di CHUNK_MAX_TOKENS token, senza docling.
+
+    Il testo viene tokenizzato una sola volta; ogni finestra viene poi decodificata.
+    """
+    encoding = get_tokenizer().tokenizer
+    with open(file_path, encoding="utf-8", errors="replace") as f:
+        ids = encoding.encode_ordinary(f.read())
+    return [
+        (encoding.decode(ids[start:start + CHUNK_MAX_TOKENS]), None)
+        for start in range(0, len(ids), CHUNK_MAX_TOKENS)
+    ]
+
+def _convert_and_chunk(file_path: str) -> Optional[List[tuple]]:
+    """Converte e suddivide un documento in (testo, pagine); eseguita nei processi worker.
+
+    Converter e chunker vengono creati una sola volta per processo.
+    """
+    # Il testo semplice non ha struttura da estrarre: niente conversione docling
+    if file_path.lower().endswith(".txt"):
+        return _chunk_text_file(file_path)
+    result = get_converter().convert(file_path)
+    if not result.document:
+        return None
+    return [(chunk.text, _page_numbers(chunk)) for chunk in get_chunker().chunk(dl_doc=result.document)]
+
+def _write_atomic(path: Path, data: bytes):
+    """Scrive un file di stato tramite file temporaneo e rename: mai lasciato a metà."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
 class DocumentService:
     def __init__(self, data_paths: List[str], config: dict, read_only: bool = False):
         self.data_paths = data_paths
@@ -25,373 +171,654 @@ class DocumentService:
         # Usa l'ID esplicito dalla config
         agent_id = config.get('id', '').lower()
         self.table_name = f"docs_{agent_id}"
+        self.embedding_batch_size = min(
+            config.get('embedding_batch_size', EMBEDDING_BATCH_SIZE), EMBEDDING_MAX_INPUTS
+        )
+        self.embedding_concurrency = max(1, config.get('embedding_concurrency', EMBEDDING_MAX_CONCURRENCY))
+        self.document_workers = max(1, config.get('document_workers') or DOCUMENT_WORKERS)
         
         self.db = connect_to_lancedb()
-        self.client = OpenAI()
+        self.client = get_openai_client()
         
-        # Se in modalità read-only, verifica che il DB sia inizializzato
-        if read_only:
-            if not self.db.table_names():
-                # Crea una tabella vuota se non esiste il DB
-                logger.info(f"Creazione tabella vuota {self.table_name}")
-                self._create_empty_table()
-            elif self.table_name not in self.db.table_names():
-                # Crea una tabella vuota se non esiste per questo agente
-                logger.info(f"Creazione tabella vuota {self.table_name}")
-                self._create_empty_table()
-            self.table = self.db.open_table(self.table_name)
-        else:
-            # Modalità normale con processing dei documenti
-            self.converter = DocumentConverter()
-            self.chunker = HybridChunker()
+        # Directory del database, usata per i file di stato accanto alle tabelle
+        self.db_path = Path(self.data_paths[0]).parents[1] / "lancedb"
+        self.db_path.mkdir(parents=True, exist_ok=True)
         
-        # Initialize components
-        self.tokenizer = OpenAITokenizerWrapper()
-        self.chunker = HybridChunker(
-            tokenizer=self.tokenizer,
-            max_tokens=8191,
-            merge_peers=True
+        # Embedding già calcolati, condivisi tra agenti ed esecuzioni
+        self.embedding_cache = EmbeddingCache(self.db_path / "embedding_cache.sqlite", EMBEDDING_MODEL)
+        self.query_embedder = EmbeddingBatcher(self.client, model=EMBEDDING_MODEL, store=self.embedding_cache)
+        # Cache dei risultati: la generazione cambia a ogni scrittura sulla tabella
+        self.search_cache = QueryCache(
+            capacity=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, similarity=SEARCH_CACHE_SIMILARITY
         )
+        # Il catalogo viene letto una sola volta; create e drop passano da questo servizio
+        self._table_exists = self.table_name in self.db.table_names()
+        
+        # Se in modalità read-only, verifica che il DB sia inizializzato
+        if read_only and not self._table_exists:
+            # Crea una tabella vuota se non esiste per questo agente
+            logger.info(f"Creazione tabella vuota {self.table_name}")
+            self._create_empty_table()
         
         # Ensure all data directories exist
         for path in self.data_paths:
             Path(path).mkdir(parents=True, exist_ok=True)
         
-        # Ensure database directory exists
-        self.db_path = Path(self.data_paths[0]).parents[1] / "lancedb"
-        self.db_path.mkdir(parents=True, exist_ok=True)
-        
-        # Initialize database with agent-specific table
-        self.db = lancedb.connect(self.db_path)
-        
         logger.info(f"DocumentService initialization completed for {self.table_name}")
 
+    @cached_property
+    def tokenizer(self) -> OpenAITokenizerWrapper:
+        return get_tokenizer()
+
+    @cached_property
+    def table(self):
+        """Handle della tabella dell'agente, aperto una sola volta."""
+        return self.db.open_table(self.table_name)
+
+    @property
+    def table_exists(self) -> bool:
+        return self._table_exists
+
+    def get_table(self):
+        """Restituisce l'handle della tabella dell'agente, aprendolo una sola volta."""
+        return self.table
+
+    def drop_table(self):
+        """Elimina la tabella dell'agente e invalida gli handle in cache."""
+        self.db.drop_table(self.table_name)
+        self._table_exists = False
+        self.__dict__.pop('table', None)
+        self.search_cache.invalidate()
+        # I file di stato descrivono la tabella eliminata: non devono sopravviverle
+        self._clear_ingest_state()
+        self._index_rows_path().unlink(missing_ok=True)
+
+    def scan_metadata(self) -> List[Dict[str, Any]]:
+        """Legge solo la colonna metadata della tabella, senza testo né vettori."""
+        return self.get_table().to_lance().to_table(columns=['metadata']).column('metadata').to_pylist()
+
+    def iter_metadata(self, batch_size: int = 8192):
+        """Come scan_metadata, ma a blocchi: la memoria resta limitata anche su tabelle grandi."""
+        for batch in self.get_table().to_lance().to_batches(columns=['metadata'], batch_size=batch_size):
+            yield from batch.column('metadata').to_pylist()
+
+    @staticmethod
+    def _source_filter(source: str) -> str:
+        escaped = source.replace("'", "''")
+        return f"metadata.source = '{escaped}'"
+
+    @classmethod
+    def _version_filter(cls, file_metadata: Dict[str, Any]) -> str:
+        """Record della versione di un documento descritta da `file_metadata`."""
+        return (
+            f"{cls._source_filter(file_metadata['source'])}"
+            f" AND metadata.file_hash = '{file_metadata['file_hash']}'"
+            f" AND metadata.last_modified = '{file_metadata['last_modified']}'"
+            f" AND metadata.file_size = {int(file_metadata['file_size'])}"
+        )
+
+    @classmethod
+    def _stale_filter(cls, file_metadata: Dict[str, Any]) -> str:
+        """Record dello stesso documento ma di un'altra versione, metadata incompleti compresi."""
+        return (
+            f"{cls._source_filter(file_metadata['source'])} AND ("
+            f"metadata.file_hash IS NULL OR metadata.file_hash != '{file_metadata['file_hash']}'"
+            f" OR metadata.last_modified IS NULL OR metadata.last_modified != '{file_metadata['last_modified']}'"
+            f" OR metadata.file_size IS NULL OR metadata.file_size != {int(file_metadata['file_size'])})"
+        )
+
+    def get_records(self, source: str) -> List[Dict[str, Any]]:
+        """Restituisce i record completi di un singolo documento."""
+        return self.get_table().to_lance().to_table(filter=self._source_filter(source)).to_pylist()
+
+    def replace_records(self, source: str, records: List[Dict[str, Any]]):
+        """Sostituisce i record salvati di un documento con quelli indicati.
+
+        I record devono descrivere tutti la stessa versione del documento (stessi
+        file_hash, last_modified e file_size): vengono scritti prima, e solo dopo
+        vengono eliminati quelli di altre versioni. Se la scrittura fallisce i
+        record precedenti restano intatti.
+        """
+        if not records:
+            return
+        table = self.get_table()
+        # Conversione esplicita sullo schema della tabella, vettori float16 compresi
+        table.add(pa.Table.from_pylist(records, schema=table.schema))
+        table.delete(self._stale_filter({**records[0]['metadata'], 'source': source}))
+        self.search_cache.invalidate()
+
+
+    def ensure_vector_index(self, rebuild: bool = False):
+        """Crea l'indice ANN (IVF_PQ) sui vettori quando la tabella è abbastanza grande."""
+        if not self._table_exists:
+            return
+        table = self.get_table()
+        num_rows = table.count_rows()
+        if num_rows < VECTOR_INDEX_MIN_ROWS:
+            return
+        has_index = any('vector' in index.columns for index in table.list_indices())
+        if has_index and not rebuild:
+            # I nuovi record vengono gestiti dalla manutenzione incrementale di LanceDB,
+            # finché la tabella non è cresciuta abbastanza da sbilanciare le partizioni
+            indexed_rows = self._read_indexed_rows()
+            if indexed_rows and num_rows < indexed_rows * VECTOR_INDEX_REBUILD_GROWTH:
+                return
+        
+        logger.info(f"Creazione indice vettoriale per {self.table_name} ({num_rows} record)")
+        table.create_index(
+            metric="cosine",
+            vector_column_name="vector",
+            index_type="IVF_PQ",
+            num_partitions=min(256, int(math.sqrt(num_rows))),
+            num_sub_vectors=VECTOR_INDEX_SUB_VECTORS,
+            replace=True
+        )
+        _write_atomic(self._index_rows_path(), str(num_rows).encode())
+
+    def _index_rows_path(self) -> Path:
+        return self.db_path / f"{self.table_name}.index_rows"
+
+    def _read_indexed_rows(self) -> int:
+        """Numero di record presenti all'ultima costruzione dell'indice (0 se sconosciuto)."""
+        path = self._index_rows_path()
+        return int(path.read_text()) if path.exists() else 0
+
     def _create_empty_table(self):
         """Crea una tabella vuota con la struttura corretta."""
-        empty_data = [{
-            "text": "",
-            "vector": [0.0] * 1536,  # dimensione standard per embedding OpenAI
-            "metadata": {
-                "source": "",
-                "filename": "",
-                "page_numbers": [],
-                "last_modified": "",
-                "file_hash": "",
-                "file_size": 0
-            }
-        }]
-        self.db.create_table(self.table_name, data=empty_data)
-        table = self.db.open_table(self.table_name)
-        # Rimuovi il record vuoto iniziale
-        table.delete("text = ''")
+        # Solo schema: nessun record fittizio da inserire e poi cancellare
+        self.table = self.db.create_table(self.table_name, schema=TABLE_SCHEMA)
+        self._table_exists = True
         logger.info(f"Tabella vuota {self.table_name} creata con successo")
 
+    def _compact_table(self):
+        """Unisce i frammenti creati dalle scritture per batch, così le ricerche ne leggono pochi."""
+        try:
+            self.get_table().optimize()
+        except Exception as e:
+            # Solo manutenzione: i dati sono già scritti
+            logger.warning(f"Compattazione della tabella {self.table_name} non riuscita: {e}")
+
+    def _ingest_state_path(self) -> Path:
+        return self.db_path / f"{self.table_name}.ingest_state.json"
+
+    @staticmethod
+    def _files_fingerprint(files: List[Path]) -> str:
+        """Impronta di nomi, dimensioni e mtime dei file: cambia se un file viene aggiunto, rimosso o modificato."""
+        digest = hashlib.blake2b(digest_size=16)
+        for file_path in sorted(files):
+            file_stat = file_path.stat()
+            digest.update(f"{file_path}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def _is_index_fresh(self, fingerprint: str) -> bool:
+        """Vero se i file sono identici a quelli dell'ultima indicizzazione."""
+        state_path = self._ingest_state_path()
+        if not state_path.exists():
+            return False
+        try:
+            return orjson.loads(state_path.read_bytes()).get('fingerprint') == fingerprint
+        except orjson.JSONDecodeError:
+            # Stato illeggibile: si ricontrollano i file
+            return False
+
+    def _clear_ingest_state(self):
+        """Rimuove l'impronta salvata: finché un'indicizzazione non si conclude, nulla risulta aggiornato."""
+        self._ingest_state_path().unlink(missing_ok=True)
+
+    def _mark_indexed(self, fingerprint: str):
+        _write_atomic(self._ingest_state_path(), orjson.dumps({'fingerprint': fingerprint}))
+
     def process_documents(self):
         """Process all documents from all configured paths."""
         try:
             start_time = time.time()
-            processed_chunks = []
             total_documents = 0
             total_chunks = 0
             
-            # Process each directory
-            files_found = False
-            files_to_process = []
-            
             # Raccogli tutti i file da processare
-            for data_path in self.data_paths:
-                path = Path(data_path)
-                logger.info(f"Processing documents in: {path}")
-                
-                # Check if directory contains supported files
-                for file_path in path.glob("*.*"):
-                    if file_path.suffix.lower() in ['.pdf', '.txt', '.docx']:
-                        files_to_process.append(file_path)
-                        files_found = True
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Processing documents in: %s", ', '.join(self.data_paths))
+            files_to_process = list(iter_supported_files(self.data_paths))
+            files_found = bool(files_to_process)
             
             if not files_found:
-                logger.warning(f"Nessun documento supportato trovato per l'agente {self.config.get('name')}. "
-                             f"Percorsi controllati: {', '.join(str(p) for p in self.data_paths)}")
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Nessun documento supportato trovato per l'agente %s. Percorsi controllati: %s",
+                                   self.config.get('name'), ', '.join(str(p) for p in self.data_paths))
                 return
             
+            # Impronta calcolata prima dell'elaborazione: i file modificati nel frattempo
+            # verranno ripresi al prossimo refresh
+            fingerprint = self._files_fingerprint(files_to_process)
+            
             # Se la tabella esiste, usa la logica incrementale
-            if self.table_name in self.db.table_names():
+            if self._table_exists:
+                if self._is_index_fresh(fingerprint):
+                    logger.info(f"Tabella {self.table_name} già aggiornata, nessun file modificato")
+                    return
+                
                 logger.info(f"Tabella {self.table_name} esistente, verifico aggiornamenti...")
-                table = self.db.open_table(self.table_name)
+                # Un'esecuzione fallita non deve lasciare in vigore l'impronta precedente
+                self._clear_ingest_state()
+                table = self.get_table()
                 existing_files = {}
-                existing_records = {}
                 
                 if 'metadata' in table.schema.names:
-                    df = table.to_pandas()
-                    if not df.empty and 'metadata' in df.columns:
-                        for _, row in df.iterrows():
-                            metadata = row.metadata
-                            source = metadata['source']
-                            if source not in existing_records:
-                                existing_records[source] = []
-                            existing_records[source].append(row.to_dict())
-                            
-                            existing_files[source] = {
-                                'hash': metadata.get('file_hash', ''),
-                                'mtime': metadata.get('last_modified', ''),
-                                'size': metadata.get('file_size', 0)
-                            }
+                    # Solo la colonna metadata: testo e vettori non servono al confronto
+                    for metadata in self.iter_metadata():
+                        existing_files[metadata['source']] = {
+                            'hash': metadata.get('file_hash', ''),
+                            'mtime': metadata.get('last_modified', ''),
+                            'size': metadata.get('file_size', 0)
+                        }
                 
                 # Processa solo i file nuovi o modificati
                 new_or_modified = []
+                modified = []
                 for file_path in files_to_process:
                     file_str = str(file_path)
                     if file_str not in existing_files:
                         new_or_modified.append(file_path)
                         continue
                     
-                    current_hash = calculate_file_hash(file_path)
-                    current_mtime = datetime.fromtimestamp(file_path.stat().st_mtime).isoformat()
-                    current_size = file_path.stat().st_size
-                    
+                    # Bastano stat e metadata salvati: nessuna lettura del file
+                    file_stat = file_path.stat()
+                    current_mtime = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
                     stored_info = existing_files[file_str]
                     if not all(stored_info.values()) or (
-                        current_hash != stored_info['hash'] or 
                         current_mtime != stored_info['mtime'] or 
-                        current_size != stored_info['size']
+                        file_stat.st_size != stored_info['size']
                     ):
                         new_or_modified.append(file_path)
+                        modified.append(file_path)
                 
                 if new_or_modified:
                     logger.info(f"Trovati {len(new_or_modified)} file da aggiornare")
-                    self.add_documents(new_or_modified, existing_records)
+                    # L'impronta copre tutti i file: si salva solo se nessuno è fallito,
+                    # altrimenti i file falliti non verrebbero più riprovati
+                    _, complete = self.add_documents(new_or_modified, replaced_files=modified)
+                    if complete:
+                        self._mark_indexed(fingerprint)
                 else:
                     logger.info("Nessun aggiornamento necessario")
+                    self._mark_indexed(fingerprint)
                 
                 return
             
             # Se la tabella non esiste, processa tutto
             logger.info("Creazione nuova tabella...")
-            self.add_documents(files_to_process)
+            self._clear_ingest_state()
+            _, complete = self.add_documents(files_to_process)
+            if complete:
+                self._mark_indexed(fingerprint)
                 
         except Exception as e:
             logger.error(f"Error processing documents: {str(e)}", exc_info=True)
 
-    def search_documents(self, query: str, num_results: int = 3) -> List[Dict[str, Any]]:
-        """Search for relevant documents."""
+    def search_documents(self, query: str, num_results: int = 3, nprobes: int = SEARCH_NPROBES,
+                         refine_factor: int = SEARCH_REFINE_FACTOR) -> List[Dict[str, Any]]:
+        """Search for relevant documents.
+
+        nprobes e refine_factor regolano il compromesso recall/latenza dell'indice
+        IVF_PQ; sono ignorati finché la tabella non ha un indice.
+        """
+        cached = self.search_cache.get(query, num_results)
+        if cached is not None:
+            logger.info("Risultati in cache per la query: %.50s...", query)
+            return cached
+        
+        generation = self.search_cache.generation
+        results, query_vector = self._search_documents(query, num_results, nprobes, refine_factor)
+        if results and query_vector is not None:
+            self.search_cache.put(query, num_results, query_vector, results, generation)
+        return results
+
+    def search_documents_batch(self, queries: List[str],
+                               num_results: Union[int, List[int]] = 3) -> List[List[Dict[str, Any]]]:
+        """Esegue più ricerche in parallelo, restituendo i risultati nell'ordine delle query.
+
+        Gli embedding delle query concorrenti vengono uniti dal query_embedder
+        in un'unica richiesta; le ricerche su LanceDB girano in thread separati.
+        """
+        if isinstance(num_results, int):
+            num_results = [num_results] * len(queries)
+        if len(queries) <= 1:
+            return [self.search_documents(query, n) for query, n in zip(queries, num_results)]
+        with ThreadPoolExecutor(max_workers=min(SEARCH_BATCH_WORKERS, len(queries))) as executor:
+            return list(executor.map(self.search_documents, queries, num_results))
+
+    def _search_documents(self, query: str, num_results: int, nprobes: int, refine_factor: int):
+        """Esegue la ricerca; restituisce i risultati e l'embedding normalizzato della query."""
         try:
-            logger.info(f"Searching documents for query: {query[:50]}...")
+            logger.info("Searching documents for query: %.50s...", query)
             
-            table = self.db.open_table(self.table_name)
-            df = table.to_pandas()
-            if df.empty:
+            table = self.get_table()
+            if table.count_rows() == 0:
                 logger.info(f"Nessun documento trovato per l'agente {self.config.get('name')}")
-                return []
+                return [], None
             
             start_time = time.time()
             
-            response = self.client.embeddings.create(
-                model="text-embedding-3-small",
-                input=query
-            )
+            # Le query concorrenti vengono embeddate in un'unica richiesta
+            query_embedding = self.query_embedder.embed(query)
+            query_vector = normalize(query_embedding)
+            
+            similar = self.search_cache.lookup(query_vector, num_results)
+            if similar is not None:
+                logger.info("Risultati in cache per una query simile a: %.50s...", query)
+                return similar, None
             
-            results = table.search(response.data[0].embedding).limit(num_results).to_pandas()
+            results = (
+                table.search(query_embedding)
+                .metric("cosine")
+                .nprobes(nprobes)
+                .refine_factor(refine_factor)
+                .limit(num_results)
+                .select(["text", "metadata", "_distance"])
+                .to_arrow()
+            )
             
             search_time = time.time() - start_time
-            logger.info(f"Found {len(results)} results in {search_time:.2f} seconds")
+            logger.info("Found %d results in %.2f seconds", results.num_rows, search_time)
             
+            # Conversione per colonna da Arrow, senza DataFrame né iterrows
             return [
-                {
-                    'text': row['text'],
-                    'metadata': row['metadata'],
-                    'score': row['_distance']
-                }
-                for _, row in results.iterrows()
-            ]
+                {'text': text, 'metadata': metadata, 'score': score}
+                for text, metadata, score in zip(
+                    results.column('text').to_pylist(),
+                    results.column('metadata').to_pylist(),
+                    results.column('_distance').to_pylist()
+                )
+            ], query_vector
             
         except Exception as e:
             logger.error(f"Error searching documents: {str(e)}", exc_info=True)
-            return []
+            return [], None
+
+    def _iter_embedding_batches(self, texts: List[str]):
+        """Divide i testi in batch limitati sia per numero sia per token totali."""
+        batch, batch_tokens = [], 0
+        # Conteggio in un'unica chiamata: tiktoken tokenizza i testi su più thread
+        for text, num_tokens in zip(texts, self.tokenizer.count_tokens_batch(texts)):
+            if batch and (len(batch) >= self.embedding_batch_size or
+                          batch_tokens + num_tokens > EMBEDDING_MAX_BATCH_TOKENS):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += num_tokens
+        if batch:
+            yield batch
+
+    def _embed_texts(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Calcola gli embedding inviando più testi per ogni richiesta.
+
+        Gli embedding già presenti nella cache su disco non vengono richiesti;
+        i batch vengono inviati in parallelo (al massimo embedding_concurrency
+        alla volta); se un batch fallisce i suoi testi vengono riprovati uno alla
+        volta e per quelli che falliscono ancora viene restituito None.
+        """
+        # Testi ripetuti (intestazioni, piè di pagina, note legali) vengono embeddati una volta sola
+        unique_texts = list(dict.fromkeys(texts))
+        embeddings = self.embedding_cache.get_many(unique_texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            logger.info("%d embedding in cache, %d da calcolare (%d testi duplicati)",
+                        len(unique_texts) - len(missing), len(missing), len(texts) - len(unique_texts))
+            fresh = asyncio.run(self._aembed_texts([unique_texts[i] for i in missing]))
+            for i, embedding in zip(missing, fresh):
+                embeddings[i] = embedding
+            self.embedding_cache.put_many([
+                (unique_texts[i], embedding) for i, embedding in zip(missing, fresh) if embedding is not None
+            ])
+        if len(unique_texts) == len(texts):
+            return embeddings
+        by_text = dict(zip(unique_texts, embeddings))
+        return [by_text[text] for text in texts]
+
+    async def _aembed_texts(self, texts: List[str]) -> List[Optional[List[float]]]:
+        semaphore = asyncio.Semaphore(self.embedding_concurrency)
+        # Client creato dentro il loop: le connessioni httpx sono legate al loop corrente
+        async with AsyncOpenAI() as aclient:
+            results = await asyncio.gather(*(
+                self._aembed_batch(aclient, batch, semaphore)
+                for batch in self._iter_embedding_batches(texts)
+            ))
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+
+    async def _aembed_batch(self, aclient, batch: List[str], semaphore) -> List[Optional[List[float]]]:
+        async with semaphore:
+            delay = EMBEDDING_RETRY_BASE_DELAY
+            for attempt in range(1, EMBEDDING_MAX_ATTEMPTS + 1):
+                try:
+                    response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+                    return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+                except Exception as e:
+                    if attempt == EMBEDDING_MAX_ATTEMPTS:
+                        logger.warning("Batch di %d embedding fallito (%s), riprovo singolarmente", len(batch), e)
+                        break
+                    wait = self._retry_delay(e, delay)
+                    logger.warning("Batch di %d embedding fallito (%s), nuovo tentativo tra %.1fs", len(batch), e, wait)
+                    await asyncio.sleep(wait)
+                    delay = min(EMBEDDING_RETRY_MAX_DELAY, delay * 2)
+            
+            embeddings = []
+            for text in batch:
+                try:
+                    response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=text)
+                    embeddings.append(response.data[0].embedding)
+                except Exception as e:
+                    logger.error("Embedding fallito per un chunk: %s", e)
+                    embeddings.append(None)
+            return embeddings
+
+    @staticmethod
+    def _retry_delay(error: Exception, delay: float) -> float:
+        """Attesa prima del prossimo tentativo: backoff con jitter, o il Retry-After di un 429."""
+        if isinstance(error, RateLimitError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                return min(EMBEDDING_RETRY_MAX_DELAY, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        # Jitter pieno: le richieste in volo fallite insieme non ripartono insieme
+        return random.uniform(0, delay)
+
+    @staticmethod
+    def _file_metadata(file_path: Path) -> Dict[str, Any]:
+        """Metadata a livello di file, calcolati una volta e condivisi da tutti i suoi chunk."""
+        file_stat = file_path.stat()
+        return {
+            "source": str(file_path),
+            "filename": file_path.name,
+            "last_modified": datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
+            "file_hash": calculate_file_hash(file_path),
+            "file_size": file_stat.st_size
+        }
+
+    @staticmethod
+    def _chunk_metadata(page_numbers: Optional[List[int]], file_metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Metadata di un chunk: quelli del file più le pagine di provenienza."""
+        return {
+            "source": file_metadata["source"],
+            "filename": file_metadata["filename"],
+            "page_numbers": page_numbers,
+            "last_modified": file_metadata["last_modified"],
+            "file_hash": file_metadata["file_hash"],
+            "file_size": file_metadata["file_size"]
+        }
+
+    def _convert_files(self, file_paths: List[str]):
+        """Converte e suddivide i documenti, in parallelo su più processi quando sono più di uno.
 
-    def add_documents(self, file_paths: List[Path], existing_records: Dict[str, List[Dict]] = None):
-        """Aggiunge nuovi documenti usando Batch API."""
+        I risultati arrivano man mano, in ordine: il chiamante può embeddare i primi
+        file mentre i worker convertono i successivi.
+        """
+        workers = min(self.document_workers, len(file_paths))
+        if workers <= 1:
+            yield from map(_convert_and_chunk, file_paths)
+            return
+        # spawn: il fork di un processo con thread attivi (Streamlit, refresh) non è sicuro
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                 initializer=_init_worker) as pool:
+            yield from pool.map(_convert_and_chunk, file_paths)
+
+    def _embed_pending(self, pending_chunks: List[tuple]) -> Tuple[int, set]:
+        """Embedda i chunk in attesa e li scrive subito nella tabella.
+
+        Restituisce i chunk salvati e i documenti con almeno un embedding fallito.
+        """
+        logger.info("Embedding di %d chunks in batch da %d", len(pending_chunks), self.embedding_batch_size)
+        pending_embeddings = self._embed_texts([text for text, *_ in pending_chunks])
+        texts, metadatas = [], []
+        failed_sources = set()
+        # Un solo buffer contiguo già nel tipo della colonna, invece di una lista Python per vettore
+        vectors = np.empty((len(pending_chunks), EMBEDDING_DIMENSIONS), dtype=VECTOR_VALUE_TYPE.to_pandas_dtype())
+        for (text, page_numbers, file_metadata), embedding in zip(pending_chunks, pending_embeddings):
+            if embedding is not None:
+                vectors[len(texts)] = embedding
+                texts.append(text)
+                metadatas.append(self._chunk_metadata(page_numbers, file_metadata))
+            else:
+                failed_sources.add(file_metadata["source"])
+        if texts:
+            if not self._table_exists:
+                self._create_empty_table()
+            # Scrittura per batch: la memoria resta proporzionale al batch, non al corpus
+            self.get_table().add(self._to_arrow(texts, vectors[:len(texts)], metadatas))
+        return len(texts), failed_sources
+
+    def _finish_file(self, file_metadata: Dict[str, Any], failed: bool, replaced: bool) -> bool:
+        """Chiude un documento i cui chunk sono stati tutti scritti (o tentati).
+
+        Ogni documento è tutto o niente: se un suo chunk è fallito la nuova versione
+        viene rimossa, e resta quella precedente; altrimenti, per i file sostituiti,
+        vengono rimossi solo ora i chunk della versione precedente.
+        Restituisce True se la tabella è stata modificata.
+        """
+        if not self._table_exists:
+            return False
+        if failed:
+            logger.warning("Embedding incompleti per %s: la nuova versione viene scartata", file_metadata["source"])
+            self.get_table().delete(self._version_filter(file_metadata))
+            return True
+        if replaced:
+            self.get_table().delete(self._stale_filter(file_metadata))
+            return True
+        return False
+
+    @staticmethod
+    def _to_arrow(texts: List[str], vectors: np.ndarray, metadatas: List[Dict[str, Any]]) -> pa.Table:
+        """Costruisce la tabella Arrow per colonne: i vettori passano come un unico buffer."""
+        flat_vectors = pa.array(np.asarray(vectors, dtype=VECTOR_VALUE_TYPE.to_pandas_dtype()).reshape(-1))
+        return pa.table({
+            "text": pa.array(texts, type=pa.string()),
+            "vector": pa.FixedSizeListArray.from_arrays(flat_vectors, EMBEDDING_DIMENSIONS),
+            "metadata": pa.array(metadatas, type=METADATA_TYPE)
+        }, schema=TABLE_SCHEMA)
+
+    def add_documents(self, file_paths: List[Path], replaced_files: Iterable[Path] = (),
+                      rebuild_index: bool = False) -> Tuple[int, bool]:
+        """Aggiunge nuovi documenti calcolando gli embedding in batch.
+
+        Restituisce i chunk salvati e se tutti i file e tutti i chunk sono andati a
+        buon fine: solo in quel caso l'indicizzazione può considerarsi aggiornata.
+
+        I chunk già salvati dei file in `replaced_files` vengono eliminati solo dopo
+        che tutti i chunk della nuova versione sono stati scritti; i testi invariati
+        non vengono riembeddati grazie alla cache degli embedding.
+        """
+        num_chunks = 0
+        complete = True
         try:
             if not file_paths:
                 logger.info("Nessun nuovo documento da aggiungere")
-                return []
+                return 0, True
 
             start_time = time.time()
-            processed_chunks = []
-            
-            # Configurazione ottimizzata
-            POLLING_INTERVAL = 10  # invariato
-            MAX_WAIT_TIME = 30 * 60  # invariato
-            MIN_CHUNKS_FOR_BATCH = 5  # nuovo: minimo numero di chunks per usare batch
+            replaced_sources = {str(p) for p in replaced_files}
+            # Metadata e chunk non ancora scritti di ogni documento in corso
+            unfinished = {}
+            failed_sources = set()
+            changed = False
+
+            def flush(batch):
+                nonlocal num_chunks, changed
+                written, failed = self._embed_pending(batch)
+                num_chunks += written
+                changed = changed or bool(written)
+                failed_sources.update(failed)
+                # Un documento è concluso quando l'ultimo dei suoi chunk è stato scritto
+                for source, count in Counter(fm["source"] for _, _, fm in batch).items():
+                    file_metadata, remaining = unfinished[source]
+                    if remaining > count:
+                        unfinished[source] = (file_metadata, remaining - count)
+                        continue
+                    del unfinished[source]
+                    if self._finish_file(file_metadata, source in failed_sources, source in replaced_sources):
+                        changed = True
+
+            # Chunk in attesa di embedding: inviati appena riempiono tutte le richieste in volo
+            pending_chunks = []
+            flush_size = self.embedding_batch_size * self.embedding_concurrency
             
-            for file_path in file_paths:
-                doc_start_time = time.time()
-                logger.info(f"Processing document: {file_path}")
-                
-                # Convert document
-                result = self.converter.convert(str(file_path))
-                if not result.document:
-                    logger.error(f"Failed to convert document: {file_path}")
-                    continue
-                
-                # Apply chunking
-                chunks = list(self.chunker.chunk(dl_doc=result.document))
-                chunk_count = len(chunks)
-                logger.info(f"Created {chunk_count} chunks from {file_path}")
-                
-                # Decisione se usare batch o chiamate sincrone
-                if chunk_count < MIN_CHUNKS_FOR_BATCH:
-                    logger.info(f"Processing {chunk_count} chunks synchronously (below batch threshold)")
-                    # Processo sincrono per pochi chunks
-                    chunk_embeddings = []
-                    for chunk in chunks:
-                        response = self.client.embeddings.create(
-                            model="text-embedding-3-small",
-                            input=chunk.text
-                        )
-                        chunk_embeddings.append(response.data[0].embedding)
-                        logger.debug(f"Processed chunk synchronously")
-                else:
-                    # Processo batch per molti chunks
-                    logger.info(f"Processing {chunk_count} chunks via batch API")
-                    # Prepare batch file
-                    batch_requests = []
-                    for i, chunk in enumerate(chunks):
-                        batch_requests.append({
-                            "custom_id": f"{file_path}_{i}",
-                            "method": "POST",
-                            "url": "/v1/embeddings",
-                            "body": {
-                                "model": "text-embedding-3-small",
-                                "input": chunk.text
-                            }
-                        })
-                    
-                    # Create temporary JSONL file
-                    with tempfile.NamedTemporaryFile(mode='w', suffix='.jsonl', delete=False) as f:
-                        for request in batch_requests:
-                            f.write(json.dumps(request) + '\n')
-                    
-                    try:
-                        # Upload batch file
-                        logger.info("Uploading batch file...")
-                        with open(f.name, 'rb') as file:
-                            batch_file = self.client.files.create(
-                                file=file,
-                                purpose="batch"
-                            )
-                        
-                        # Create batch
-                        logger.info("Creating batch job...")
-                        batch = self.client.batches.create(
-                            input_file_id=batch_file.id,
-                            endpoint="/v1/embeddings",
-                            completion_window="24h"
-                        )
-                        
-                        logger.info(f"Created batch {batch.id} for {file_path}")
-                        
-                        # Wait for batch completion with timeout
-                        timeout_time = datetime.now() + timedelta(seconds=MAX_WAIT_TIME)
-                        last_progress = 0
-                        
-                        while datetime.now() < timeout_time:
-                            batch_status = self.client.batches.retrieve(batch.id)
-                            
-                            # Calcola e mostra il progresso
-                            if batch_status.request_counts.total > 0:
-                                progress = (batch_status.request_counts.completed / 
-                                          batch_status.request_counts.total) * 100
-                                if progress > last_progress + 20:  # Log ogni 20% invece di 5%
-                                    logger.info(f"Batch progress: {progress:.1f}% completed")
-                                    last_progress = progress
-                            
-                            if batch_status.status == "completed":
-                                logger.info("Batch completed successfully!")
-                                break
-                            elif batch_status.status in ["failed", "expired", "cancelled"]:
-                                raise Exception(f"Batch failed with status: {batch_status.status}")
-                            
-                            time.sleep(POLLING_INTERVAL)
-                        else:
-                            raise Exception(f"Batch processing timed out after {MAX_WAIT_TIME/60:.1f} minutes")
-                        
-                        # Get results
-                        logger.info("Retrieving batch results...")
-                        output = self.client.files.content(batch_status.output_file_id)
-                        results = [json.loads(line) for line in output.text.splitlines()]
-                        
-                        # Process results
-                        successful_chunks = 0
-                        for chunk, result in zip(chunks, results):
-                            if result.get("error") is None:
-                                embedding = result["response"]["body"]["data"][0]["embedding"]
-                                processed_chunks.append({
-                                    "text": chunk.text,
-                                    "vector": embedding,
-                                    "metadata": {
-                                        "source": str(file_path),
-                                        "filename": Path(file_path).name,
-                                        "page_numbers": [
-                                            page_no for page_no in sorted(
-                                                set(prov.page_no for item in chunk.meta.doc_items for prov in item.prov)
-                                            )
-                                        ] if hasattr(chunk.meta, 'doc_items') else None,
-                                        "last_modified": datetime.fromtimestamp(file_path.stat().st_mtime).isoformat(),
-                                        "file_hash": calculate_file_hash(file_path),
-                                        "file_size": file_path.stat().st_size
-                                    }
-                                })
-                                successful_chunks += 1
-                        
-                        logger.info(f"Successfully processed {successful_chunks}/{len(chunks)} chunks")
-                        
-                    finally:
-                        # Cleanup
-                        Path(f.name).unlink()
-                        logger.debug("Cleaned up temporary files")
+            logger.info("Conversione di %d documenti su %d processi", len(file_paths), min(self.document_workers, len(file_paths)))
+            try:
+                for file_path, chunks in zip(file_paths, self._convert_files([str(p) for p in file_paths])):
+                    if chunks is None:
+                        logger.error("Failed to convert document: %s", file_path)
+                        complete = False
+                        continue
                     
-                    doc_process_time = time.time() - doc_start_time
-                    logger.info(f"Document processing completed in {doc_process_time:.2f} seconds")
-
-            # Add to database
-            if processed_chunks:
-                if self.table_name in self.db.table_names():
-                    table = self.db.open_table(self.table_name)
-                    table.add(processed_chunks)
-                else:
-                    self.db.create_table(self.table_name, data=processed_chunks)
+                    logger.info("Created %d chunks from %s", len(chunks), file_path)
+                    file_metadata = self._file_metadata(Path(file_path))
+                    if not chunks:
+                        # Documento vuoto: la versione precedente va comunque rimossa
+                        if self._finish_file(file_metadata, False, file_metadata["source"] in replaced_sources):
+                            changed = True
+                        continue
+                    unfinished[file_metadata["source"]] = (file_metadata, len(chunks))
+                    pending_chunks.extend((text, page_numbers, file_metadata) for text, page_numbers in chunks)
+                    if len(pending_chunks) >= flush_size:
+                        flush(pending_chunks)
+                        logger.info("Salvati %d chunks finora", num_chunks)
+                        pending_chunks = []
+
+                if pending_chunks:
+                    flush(pending_chunks)
+            finally:
+                # Documenti interrotti da un errore: via le parti già scritte della nuova versione
+                if unfinished and self._table_exists:
+                    for file_metadata, _ in unfinished.values():
+                        self.get_table().delete(self._version_filter(file_metadata))
+                    changed = True
+                # Anche dopo un errore le scritture già fatte rendono obsoleti i risultati in cache
+                if changed:
+                    self.search_cache.invalidate()
+
+            complete = complete and not failed_sources
+            if changed:
+                self._compact_table()
+                self.ensure_vector_index(rebuild=rebuild_index)
                 
                 total_time = time.time() - start_time
-                logger.info(f"Total processing time: {total_time:.2f} seconds for {len(processed_chunks)} chunks")
+                logger.info("Total processing time: %.2f seconds for %d chunks", total_time, num_chunks)
             
-            return processed_chunks
+            return num_chunks, complete
             
         except Exception as e:
             logger.error(f"Error adding documents: {str(e)}", exc_info=True)
-            return []
-
-    def update_metadata(self, records: List[Dict], file_paths: List[Path]) -> List[Dict]:
-        """Aggiorna i metadata dei record esistenti."""
-        try:
-            updated_records = []
-            for record in records:
-                file_path = Path(record['metadata']['source'])
-                if file_path in file_paths:
-                    record['metadata'].update({
-                        "last_modified": datetime.fromtimestamp(file_path.stat().st_mtime).isoformat(),
-                        "file_hash": calculate_file_hash(file_path),
-                        "file_size": file_path.stat().st_size
-                    })
-                updated_records.append(record)
-            return updated_records
-        except Exception as e:
-            logger.error(f"Error updating metadata: {str(e)}", exc_info=True)
-            return records
+            return num_chunks, False
 
 def calculate_file_hash(file_path: Path) -> str:
     """Calcola l'hash MD5 di un file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest() 
\ No newline at end of file
+    # Serve solo a rilevare modifiche: niente vincoli crittografici
+    with open(file_path, "rb", buffering=0) as f:
+        # Python >= 3.11: ciclo di lettura in C che rilascia il GIL
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, lambda: hashlib.md5(usedforsecurity=False)).hexdigest()
+        hash_md5 = hashlib.md5(usedforsecurity=False)
+        # Un solo update sul file mappato in memoria, invece di un ciclo di read
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_md5.update(mapped)
+    return hash_md5.hexdigest()
@@ -0,0 +1,68 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Limite prudente di parametri per singola query SQLite
+SQLITE_MAX_PARAMS = 500
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model, sha256(text)), stored in SQLite.
+
+    Shared by every agent and by separate processes (app and cli): unchanged
+    chunks and repeated queries are never embedded twice across runs.
+    """
+
+    def __init__(self, path: Path, model: str):
+        self.path = Path(path)
+        self.model = model
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # Una connessione per thread: sqlite3 non le condivide tra thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}|{text}".encode()).digest()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Embedding in cache per ogni testo, None dove manca."""
+        keys = [self._key(text) for text in texts]
+        found = {}
+        conn = self._connection()
+        for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+            batch = keys[i:i + SQLITE_MAX_PARAMS]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            found.update(rows)
+        return [
+            np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None
+            for key in keys
+        ]
+
+    def put_many(self, items: Sequence[Tuple[str, Sequence[float]]]):
+        """Salva gli embedding calcolati."""
+        if not items:
+            return
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(self._key(text), np.asarray(embedding, dtype=np.float32).tobytes())
+                 for text, embedding in items]
+            )
@@ -0,0 +1,89 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingBatcher:
+    """Coalesce concurrent query embeddings into a single OpenAI request.
+
+    Callers block on `embed`; a background worker drains the queue for up to
+    `max_wait` seconds (or `max_batch_size` queries) and embeds them together.
+    The last `cache_size` embeddings are kept in an LRU so repeated queries
+    skip the request entirely; an optional persistent `store` (EmbeddingCache)
+    is checked on LRU misses and filled after each request.
+    """
+
+    def __init__(self, client, model: str = "text-embedding-3-small",
+                 max_batch_size: int = 64, max_wait: float = 0.02,
+                 cache_size: int = 512, store=None):
+        self.client = client
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.store = store
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def embed(self, text: str) -> List[float]:
+        """Return the embedding of a single text, batched with concurrent callers."""
+        with self._cache_lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                return list(cached)
+        
+        embedding = self.store.get_many([text])[0] if self.store is not None else None
+        if embedding is None:
+            self._ensure_worker()
+            future = Future()
+            self._queue.put((text, future))
+            embedding = future.result()
+            if self.store is not None:
+                self.store.put_many([(text, embedding)])
+        
+        with self._cache_lock:
+            self._cache[text] = tuple(embedding)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return embedding
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                response = self.client.embeddings.create(
+                    model=self.model,
+                    input=[text for text, _ in batch]
+                )
+                logger.debug("Embedded %d queries in one request", len(batch))
+                # Ordine garantito dall'indice di ogni embedding, non dalla posizione nella risposta
+                for (_, future), data in zip(batch, sorted(response.data, key=lambda d: d.index)):
+                    future.set_result(data.embedding)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
@@ -0,0 +1,7 @@
+from functools import lru_cache
+from openai import OpenAI
+
+@lru_cache(maxsize=None)
+def get_openai_client() -> OpenAI:
+    """Client OpenAI condiviso dai servizi: un solo pool di connessioni HTTP per processo."""
+    return OpenAI()
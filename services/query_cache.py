@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import numpy as np
+from services.similarity import cosine_scores
+
+class QueryCache:
+    """Thread-safe LRU + TTL cache of search results with semantic lookup.
+
+    Entries are keyed by (query, num_results, generation) and also keep the
+    normalized query embedding, so a near-duplicate query (cosine similarity
+    above `similarity`) can reuse them. `invalidate` bumps the generation
+    after every write to the table.
+
+    The embeddings live in one preallocated float32 matrix, grown in blocks
+    of `block_size` rows; evicted rows are reused, so a lookup is a single
+    matrix-vector product with no per-call stacking.
+    """
+
+    def __init__(self, capacity: int = 2000, ttl: float = 600, similarity: float = 0.98,
+                 block_size: int = 256):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.similarity = similarity
+        self.block_size = block_size
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._row_keys = []
+        self._free_rows = []
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._hits = 0
+        self._similar_hits = 0
+        self._misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, query: str, num_results: int) -> Optional[List[Dict[str, Any]]]:
+        """Risultati in cache per la stessa identica query."""
+        with self._lock:
+            key = (query, num_results, self._generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def lookup(self, query_vector: np.ndarray, num_results: int) -> Optional[List[Dict[str, Any]]]:
+        """Risultati di una query in cache semanticamente equivalente; conta un miss altrimenti."""
+        now = time.monotonic()
+        with self._lock:
+            if self._row_keys:
+                scores = cosine_scores(self._matrix[:len(self._row_keys)], query_vector)
+                rows = np.flatnonzero(scores >= self.similarity)
+                # Dalla riga più simile: la prima ancora valida è il risultato
+                for row in rows[np.argsort(-scores[rows])]:
+                    key = self._row_keys[row]
+                    if key is None or key[1] != num_results:
+                        continue
+                    entry = self._entries[key]
+                    if now - entry[0] >= self.ttl:
+                        continue
+                    self._entries.move_to_end(key)
+                    self._similar_hits += 1
+                    return entry[1]
+            self._misses += 1
+            return None
+
+    def put(self, query: str, num_results: int, query_vector: np.ndarray,
+            results: List[Dict[str, Any]], generation: int):
+        """Salva i risultati, a meno che la tabella sia cambiata durante la ricerca."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            key = (query, num_results, generation)
+            if key in self._entries:
+                self._remove(key)
+            row = self._allocate_row(len(query_vector))
+            self._matrix[row] = query_vector
+            self._row_keys[row] = key
+            self._entries[key] = (time.monotonic(), results, row)
+            if len(self._entries) > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def _allocate_row(self, dimensions: int) -> int:
+        """Riga libera della matrice, che viene estesa di un blocco quando è piena."""
+        if self._free_rows:
+            return self._free_rows.pop()
+        row = len(self._row_keys)
+        if self._matrix is None or row == len(self._matrix):
+            grown = np.zeros((row + self.block_size, dimensions), dtype=np.float32)
+            if self._matrix is not None:
+                grown[:row] = self._matrix
+            self._matrix = grown
+        self._row_keys.append(None)
+        return row
+
+    def _remove(self, key):
+        _, _, row = self._entries.pop(key)
+        # Una riga a zero ha similarità nulla e non supera mai la soglia
+        self._matrix[row] = 0
+        self._row_keys[row] = None
+        self._free_rows.append(row)
+
+    def invalidate(self):
+        """Scarta tutti i risultati: da chiamare dopo ogni scrittura sulla tabella."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._row_keys.clear()
+            self._free_rows.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._similar_hits + self._misses
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'similar_hits': self._similar_hits,
+                'misses': self._misses,
+                'hit_rate': (self._hits + self._similar_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,13 @@
+from typing import Sequence
+import numpy as np
+
+def normalize(vector: Sequence[float]) -> np.ndarray:
+    """Restituisce il vettore come float32 a norma unitaria."""
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm > 0 else array
+
+def cosine_scores(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Similarità coseno tra la query e ogni riga di `matrix` (entrambi normalizzati)."""
+    # Con al massimo SEARCH_CACHE_SIZE righe il prodotto matrice-vettore di NumPy (BLAS) basta
+    return matrix @ query
@@ -1,5 +1,12 @@
-def get_document_stats(agent_id, config, doc_service):
-    """Get statistics for a specific agent's documents."""
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+import pandas as pd
+from config.agents import AGENTS_CONFIG, AGENT_IDS
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_document_stats(agent_id, _doc_service):
+    """Get statistics for a specific agent's documents (cached per agent)."""
+    config = AGENTS_CONFIG[agent_id]
     stats = {
         'agent_id': agent_id,
         'name': config['name'],
@@ -8,37 +15,60 @@ def get_document_stats(agent_id, config, doc_service):
         'total_chunks': 0,
         'avg_chunks_per_doc': 0,
         'last_updated': None,
+        'has_timestamps': False,
         'documents': []
     }
     
-    if doc_service.table_name in doc_service.db.table_names():
-        table = doc_service.db.open_table(doc_service.table_name)
+    if _doc_service.table_exists:
+        table = _doc_service.get_table()
         if 'metadata' in table.schema.names:
-            df = table.to_pandas()
-            if not df.empty:
-                # Collect document statistics
-                unique_docs = df['metadata'].apply(lambda x: x['source']).unique()
-                stats['total_documents'] = len(unique_docs)
-                stats['total_chunks'] = len(df)
+            # Legge solo la colonna metadata: testo e vettori non servono alle statistiche
+            metadata = _doc_service.scan_metadata()
+            if metadata:
+                # Group chunks by source document in a single pass
+                sources = pd.Series([m['source'] for m in metadata])
+                grouped = pd.Series(metadata).groupby(sources, sort=False)
+                chunk_counts = grouped.size()
+                first_metadata = grouped.first()
+                
+                stats['total_documents'] = len(chunk_counts)
+                stats['total_chunks'] = len(metadata)
                 stats['avg_chunks_per_doc'] = (stats['total_chunks'] / 
                                              stats['total_documents'] if 
                                              stats['total_documents'] > 0 else 0)
                 
                 # Collect individual document info
-                for doc in unique_docs:
-                    doc_chunks = df[df['metadata'].apply(lambda x: x['source'] == doc)]
-                    doc_metadata = doc_chunks.iloc[0]['metadata']
-                    stats['documents'].append({
+                stats['documents'] = [
+                    {
                         'filename': doc_metadata['filename'],
                         'path': doc_metadata['source'],
-                        'chunks': len(doc_chunks),
+                        'chunks': int(chunk_counts[source]),
                         'last_modified': doc_metadata.get('last_modified', 'N/A'),
                         'size': doc_metadata.get('file_size', 0)
-                    })
+                    }
+                    for source, doc_metadata in first_metadata.items()
+                ]
                 
                 # Find last update
-                last_modified = max([doc.get('last_modified', '1970-01-01') 
-                                   for doc in stats['documents']])
-                stats['last_updated'] = last_modified
+                stats['has_timestamps'] = any(doc['last_modified'] not in ('N/A', '')
+                                              for doc in stats['documents'])
+                stats['last_updated'] = max((doc.get('last_modified', '1970-01-01')
+                                             for doc in stats['documents']), default=None)
     
-    return stats 
\ No newline at end of file
+    return stats
+
+def collect_all_stats(services):
+    """Collect statistics for all agents, reading the agent tables concurrently."""
+    with ThreadPoolExecutor(max_workers=min(8, len(AGENT_IDS))) as executor:
+        return list(executor.map(
+            lambda agent_id: get_document_stats(agent_id, services[agent_id]['doc_service']),
+            AGENT_IDS
+        ))
+
+
+def collect_search_cache_stats(services):
+    """Collect the live hit/miss counters of each agent's search cache (not cached)."""
+    return [
+        {'agent_id': agent_id, **services[agent_id]['doc_service'].search_cache.get_stats()}
+        for agent_id in AGENT_IDS
+    ]
@@ -1,3 +1,4 @@
+import os
 from typing import Dict, List, Tuple
 from tiktoken import get_encoding
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
@@ -22,6 +23,14 @@ class OpenAITokenizerWrapper(PreTrainedTokenizerBase):
         """Main method used by HybridChunker."""
         return [str(t) for t in self.tokenizer.encode(text)]
 
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Number of tokens of each text, encoded in parallel outside the GIL.
+
+        Special tokens such as <|endoftext|> are counted as plain text, as in
+        the plain-text chunker, instead of raising.
+        """
+        return [len(ids) for ids in self.tokenizer.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)]
+
     def _tokenize(self, text: str) -> List[str]:
         return self.tokenize(text)
 
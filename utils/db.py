@@ -1,9 +1,16 @@
 import lancedb
 import os
+from datetime import timedelta
+from functools import lru_cache
 from pathlib import Path
 
+# Gli handle delle tabelle restano aperti a lungo: ricontrolla le scritture
+# fatte da altri processi (es. cli.py refresh) al massimo ogni 5 secondi
+READ_CONSISTENCY_INTERVAL = timedelta(seconds=5)
+
+@lru_cache(maxsize=None)
 def connect_to_lancedb():
-    """Connette al database LanceDB."""
+    """Connette al database LanceDB (una sola connessione per processo)."""
     db_path = Path("data/lancedb")
     db_path.mkdir(parents=True, exist_ok=True)
-    return lancedb.connect(str(db_path)) 
\ No newline at end of file
+    return lancedb.connect(str(db_path), read_consistency_interval=READ_CONSISTENCY_INTERVAL)
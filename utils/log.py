@@ -0,0 +1,13 @@
+import logging
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def configure_logging():
+    """Configura il logging una sola volta per processo."""
+    if logging.getLogger().hasHandlers():
+        return
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
@@ -0,0 +1,45 @@
+import logging
+import threading
+from config.agents import AGENT_ITEMS
+from services.document_service import DocumentService
+
+logger = logging.getLogger(__name__)
+
+# Un solo refresh per processo: il database è condiviso da tutte le sessioni
+_lock = threading.Lock()
+_thread = None
+_error = None
+
+def _refresh_all_documents():
+    """Riprocessa i documenti di tutti gli agenti (eseguito nel thread di background)."""
+    global _error
+    try:
+        for agent_id, config in AGENT_ITEMS:
+            doc_service = DocumentService(
+                data_paths=config['data_paths'],
+                config=config,
+                read_only=False
+            )
+            doc_service.process_documents()
+    except Exception as e:
+        logger.error(f"Errore durante il refresh: {str(e)}", exc_info=True)
+        _error = e
+
+def start_refresh() -> bool:
+    """Avvia il refresh in background; False se ne è già in corso uno."""
+    global _thread, _error
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return False
+        _error = None
+        _thread = threading.Thread(target=_refresh_all_documents, name="documents-refresh", daemon=True)
+        _thread.start()
+        return True
+
+def is_refreshing() -> bool:
+    """True mentre l'indicizzazione in background è in corso."""
+    return _thread is not None and _thread.is_alive()
+
+def refresh_error():
+    """Errore dell'ultimo refresh concluso, se presente."""
+    return _error
@@ -0,0 +1,39 @@
+import gc
+import streamlit as st
+from services.document_service import DocumentService
+from services.assistant_service import AssistantService
+from config.agents import AGENTS_CONFIG, AGENT_IDS
+
+_heap_frozen = False
+
+@st.cache_resource
+def get_agent_services(agent_id):
+    """Initialize (once) the services of a single agent in read-only mode."""
+    config = AGENTS_CONFIG[agent_id]
+    # Inizializza i servizi in modalità "read-only"
+    doc_service = DocumentService(
+        data_paths=config['data_paths'], 
+        config=config,
+        read_only=True
+    )
+    assistant_service = AssistantService(doc_service, config)
+    return {
+        'doc_service': doc_service,
+        'assistant_service': assistant_service
+    }
+
+def get_all_agent_services():
+    """Return the services of every agent, initializing the missing ones on demand."""
+    return {agent_id: get_agent_services(agent_id) for agent_id in AGENT_IDS}
+
+def freeze_startup_heap():
+    """Move the objects created at startup to the GC permanent generation, once per process.
+
+    Called after the first services are initialized: later collections during
+    reruns no longer rescan them. Freezing again after a refresh would also pin
+    the discarded services and other sessions' objects, so it happens only once.
+    """
+    global _heap_frozen
+    if not _heap_frozen:
+        _heap_frozen = True
+        gc.freeze()
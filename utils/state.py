@@ -1,12 +1,21 @@
 import streamlit as st
+from collections import deque
+from config.agents import AGENT_IDS
+
+# Numero massimo di messaggi conservati per agente
+CHAT_HISTORY_MAXLEN = 200
 
 def init_session_state():
     """Initialize session state variables."""
     if 'refresh_state' not in st.session_state:
         st.session_state.refresh_state = 'ready'
+    if 'refresh_error' not in st.session_state:
+        st.session_state.refresh_error = None
     if 'show_toast' not in st.session_state:
         st.session_state.show_toast = False
     if 'current_page' not in st.session_state:
         st.session_state.current_page = "Chat"
     if "agent_messages" not in st.session_state:
-        st.session_state.agent_messages = {} 
\ No newline at end of file
+        st.session_state.agent_messages = {
+            agent_id: deque(maxlen=CHAT_HISTORY_MAXLEN) for agent_id in AGENT_IDS
+        } 
\ No newline at end of file